@@ -0,0 +1,297 @@
+# The per-entry comparison loop of dircmp, kept in its own module so it can be compiled with
+# Cython (pure-Python mode, see setup.py). Once the listing and stat syscalls are batched away,
+# this loop is plain interpreter work - dict lookups, attribute loads, tuple compares - which is
+# exactly what compiling buys back. The module stays importable as-is, so wheels without the
+# compiled extension simply run this file.
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from stat import S_ISDIR, S_ISLNK, S_ISSOCK, S_ISBLK, S_ISCHR, S_ISFIFO
+
+# Dedicated pool for pre-fetching stat results: os.stat drops the GIL for the syscall, so this
+# overlaps up to 16 outstanding fstatat calls per directory - empirically a good fanout for SSD
+# metadata queues - independent of the traversal pool (its tasks never wait on anything).
+_io_pool = ThreadPoolExecutor(max_workers=16)
+# names per pool task; chunking amortizes the future/dispatch overhead over many syscalls
+_STAT_CHUNK = 64
+
+
+def compare_entries_follow(sink, items_a: list, items_b: list, dir_a, recursive: bool,
+                           parent_dev_a: int, parent_dev_b: int, recursion_depth: int, root_a: str,
+                           stats_a, stats_b, dir_a_fd: int, dir_b_fd: int) -> list:
+    # Match items in B-list to items in A-list, reporting differences into the sink, and return
+    # the work-queue entries for the subdirectories to descend into. This loop runs once per file
+    # in the whole tree, so the attribute/global lookups it makes every iteration are bound to
+    # locals up front.
+    #
+    # Specialized for --follow-symlinks; compare_entries_nofollow below is the same loop with the
+    # symlink-resolution code removed. follow_symlinks is fixed at CLI parse time, so main binds
+    # one of the two once instead of the loop re-testing a constant for every symlink.
+    # name -> index into items_b rather than name -> DirEntry: the dict's value slots then hold
+    # small ints (interned by CPython) instead of object pointers, and the leftover pass below
+    # walks the already-materialized list by index
+    names_b_idx = {entry.name: i for i, entry in enumerate(items_b)}
+    names_b_idx_pop = names_b_idx.pop
+    append_change_local = append_change
+    cmp_prop_local = cmp_prop
+    subdirs_to_recurse = []
+
+    # first pass: match names and report deletions; comparison waits until the stats are in
+    matched = []
+    for item_a in items_a:
+        # single pop instead of the contains/getitem/delitem triple (one hash lookup, not three)
+        idx_b = names_b_idx_pop(item_a.name, -1)
+        if idx_b < 0:
+            # scandir already built the full path string once; no per-use pathlib reassembly
+            append_change_local(sink, item_a.path, item_a.is_dir(), "deleted")
+            continue
+        matched.append((item_a, items_b[idx_b]))
+
+    # Pre-fetch the metadata of every matched pair (unless the io_uring batch already did).
+    # Stats go through _io_pool in _STAT_CHUNK-name tasks, each lstat-ing by basename relative
+    # to the held directory fds, so the comparison loop below has no blocking syscalls left in
+    # its common path; directories too small to fill one chunk are statted inline.
+    if stats_a is not None and stats_b is not None:
+        stat_pairs = [(stats_a[a.name], stats_b[a.name]) for a, _ in matched]
+    else:
+        names = [a.name for a, _ in matched]
+        if len(names) > _STAT_CHUNK:
+            stat_pairs = []
+            chunks = [(names[i:i + _STAT_CHUNK], dir_a_fd, dir_b_fd)
+                      for i in range(0, len(names), _STAT_CHUNK)]
+            for chunk_stats in _io_pool.map(_stat_chunk, chunks):
+                stat_pairs.extend(chunk_stats)
+        else:
+            stat_pairs = _stat_chunk((names, dir_a_fd, dir_b_fd))
+
+    for (item_a, item_b), (stat_a, stat_b) in zip(matched, stat_pairs):
+        name_a = item_a.name
+        path_a = item_a.path
+
+        # handle symlinks
+        if S_ISLNK(stat_a.st_mode):
+            # check if B is also a symlink
+            if not S_ISLNK(stat_b.st_mode):
+                append_change_local(sink, path_a, item_a.is_dir(), "is_symlink")
+                continue
+
+            # do not escape out of original search-path
+            # a single readlink beats Path.resolve(), which walks and stats the whole chain
+            target = os.readlink(name_a, dir_fd=dir_a_fd)
+            if not os.path.isabs(target):
+                target = os.path.normpath(os.path.join(dir_a, target))
+            if not target.startswith(root_a):
+                print(f"Absolute symlink at {path_a} points outside of searched filesystem, refusing to follow")
+            else:
+                # resolve symlink
+                stat_a = os.stat(name_a, dir_fd=dir_a_fd)
+                stat_b = os.stat(name_a, dir_fd=dir_b_fd)
+
+        # handle subdirectories
+        a_is_dir = S_ISDIR(stat_a.st_mode)
+        if a_is_dir:
+            if not S_ISDIR(stat_b.st_mode):
+                append_change_local(sink, path_a, True, "is_dir")
+                continue
+            if recursive:
+                # hand this subdirectory back to the driver's work-queue; the driver uses the
+                # (st_dev, st_ino) pairs to prune identical subtrees and hardlink cycles
+                subdirs_to_recurse.append((Path(item_a.path), Path(item_b.path),
+                                           stat_a.st_dev, stat_a.st_ino,
+                                           stat_b.st_dev, stat_b.st_ino, recursion_depth + 1))
+            # directory sizes are not comparable (see below), so the packed key omits st_size
+            key_a = (stat_a.st_mode, stat_a.st_uid, stat_a.st_gid, stat_a.st_mtime,
+                     stat_a.st_dev != parent_dev_a)
+            key_b = (stat_b.st_mode, stat_b.st_uid, stat_b.st_gid, stat_b.st_mtime,
+                     stat_b.st_dev != parent_dev_b)
+        else:
+            key_a = (stat_a.st_mode, stat_a.st_size, stat_a.st_uid, stat_a.st_gid, stat_a.st_mtime,
+                     stat_a.st_dev != parent_dev_a)
+            key_b = (stat_b.st_mode, stat_b.st_size, stat_b.st_uid, stat_b.st_gid, stat_b.st_mtime,
+                     stat_b.st_dev != parent_dev_b)
+
+        # Fast path: "everything matches" is by far the common case, and one C-level tuple
+        # comparison rejects it much cheaper than the per-field cmp_prop cascade below, which
+        # only runs when something differs and a labelled record has to be produced.
+        if key_a == key_b:
+            continue
+
+        if not a_is_dir:
+            # compare file size only for files, not folders, because different filesystem drivers
+            # have different understandings of what 'size' is on directories, which makes it incomparable
+            if cmp_prop_local("stat.st_size", path_a, a_is_dir, stat_a.st_size, stat_b.st_size, sink): continue
+
+        # compare some more relevant metadata
+        if cmp_prop_local("stat.st_uid", path_a, a_is_dir, stat_a.st_uid, stat_b.st_uid, sink): continue
+        if cmp_prop_local("stat.st_gid", path_a, a_is_dir, stat_a.st_gid, stat_b.st_gid, sink): continue
+        if cmp_prop_local("stat.st_mtime", path_a, a_is_dir, stat_a.st_mtime, stat_b.st_mtime, sink): continue
+
+        # handle mount-points: an entry is a mount-point iff it sits on a different device than
+        # the directory we found it in, and we already have both stat results in hand
+        # (Path.is_mount() would redo two stat syscalls per side to answer the same question)
+        if stat_a.st_dev != parent_dev_a:
+            if stat_b.st_dev == parent_dev_b:
+                append_change_local(sink, path_a, a_is_dir, "is_mount")
+                continue
+            # this didn't really work well and also doesn't really make sense for what we're trying to achieve...
+            #if external:
+            #    #print("mount recurse", item_a)
+            #    cmp_dir(changes, item_a, item_b, recursive, external, follow_symlinks, recursion_depth + 1)
+
+        # compare less relevant modes
+        if cmp_prop_local("is_fifo", path_a, a_is_dir, S_ISFIFO(stat_a.st_mode), S_ISFIFO(stat_b.st_mode), sink): continue
+        if cmp_prop_local("is_block_device", path_a, a_is_dir, S_ISBLK(stat_a.st_mode), S_ISBLK(stat_b.st_mode), sink): continue
+        if cmp_prop_local("is_char_device", path_a, a_is_dir, S_ISCHR(stat_a.st_mode), S_ISCHR(stat_b.st_mode), sink): continue
+        if cmp_prop_local("is_socket", path_a, a_is_dir, S_ISSOCK(stat_a.st_mode), S_ISSOCK(stat_b.st_mode), sink): continue
+
+        # catch other modes
+        if cmp_prop_local("stat.st_mode", path_a, a_is_dir, stat_a.st_mode, stat_b.st_mode, sink): continue
+
+    # anything left over in the names_b_idx dict is something that doesn't exist in dir_a (reverse difference)
+    for i in names_b_idx.values():
+        sink.add(("missing", items_b[i].path))
+
+    return subdirs_to_recurse
+
+
+def compare_entries_nofollow(sink, items_a: list, items_b: list, dir_a, recursive: bool,
+                             parent_dev_a: int, parent_dev_b: int, recursion_depth: int, root_a: str,
+                             stats_a, stats_b, dir_a_fd: int, dir_b_fd: int) -> list:
+    # The default (no --follow-symlinks) twin of compare_entries_follow above: identical except
+    # that the symlink-resolution block is gone entirely, so symlinks are only checked for
+    # type mismatch and otherwise compared by their own (lstat) metadata. dir_a and root_a are
+    # unused here but kept so both variants share one call signature.
+    # name -> index into items_b rather than name -> DirEntry: the dict's value slots then hold
+    # small ints (interned by CPython) instead of object pointers, and the leftover pass below
+    # walks the already-materialized list by index
+    names_b_idx = {entry.name: i for i, entry in enumerate(items_b)}
+    names_b_idx_pop = names_b_idx.pop
+    append_change_local = append_change
+    cmp_prop_local = cmp_prop
+    subdirs_to_recurse = []
+
+    # first pass: match names and report deletions; comparison waits until the stats are in
+    matched = []
+    for item_a in items_a:
+        # single pop instead of the contains/getitem/delitem triple (one hash lookup, not three)
+        idx_b = names_b_idx_pop(item_a.name, -1)
+        if idx_b < 0:
+            # scandir already built the full path string once; no per-use pathlib reassembly
+            append_change_local(sink, item_a.path, item_a.is_dir(), "deleted")
+            continue
+        matched.append((item_a, items_b[idx_b]))
+
+    # Pre-fetch the metadata of every matched pair (unless the io_uring batch already did).
+    # Stats go through _io_pool in _STAT_CHUNK-name tasks, each lstat-ing by basename relative
+    # to the held directory fds, so the comparison loop below has no blocking syscalls left in
+    # its common path; directories too small to fill one chunk are statted inline.
+    if stats_a is not None and stats_b is not None:
+        stat_pairs = [(stats_a[a.name], stats_b[a.name]) for a, _ in matched]
+    else:
+        names = [a.name for a, _ in matched]
+        if len(names) > _STAT_CHUNK:
+            stat_pairs = []
+            chunks = [(names[i:i + _STAT_CHUNK], dir_a_fd, dir_b_fd)
+                      for i in range(0, len(names), _STAT_CHUNK)]
+            for chunk_stats in _io_pool.map(_stat_chunk, chunks):
+                stat_pairs.extend(chunk_stats)
+        else:
+            stat_pairs = _stat_chunk((names, dir_a_fd, dir_b_fd))
+
+    for (item_a, item_b), (stat_a, stat_b) in zip(matched, stat_pairs):
+        path_a = item_a.path
+
+        # handle symlinks
+        if S_ISLNK(stat_a.st_mode):
+            # check if B is also a symlink
+            if not S_ISLNK(stat_b.st_mode):
+                append_change_local(sink, path_a, item_a.is_dir(), "is_symlink")
+                continue
+
+        # handle subdirectories
+        a_is_dir = S_ISDIR(stat_a.st_mode)
+        if a_is_dir:
+            if not S_ISDIR(stat_b.st_mode):
+                append_change_local(sink, path_a, True, "is_dir")
+                continue
+            if recursive:
+                # hand this subdirectory back to the driver's work-queue; the driver uses the
+                # (st_dev, st_ino) pairs to prune identical subtrees and hardlink cycles
+                subdirs_to_recurse.append((Path(item_a.path), Path(item_b.path),
+                                           stat_a.st_dev, stat_a.st_ino,
+                                           stat_b.st_dev, stat_b.st_ino, recursion_depth + 1))
+            # directory sizes are not comparable (see below), so the packed key omits st_size
+            key_a = (stat_a.st_mode, stat_a.st_uid, stat_a.st_gid, stat_a.st_mtime,
+                     stat_a.st_dev != parent_dev_a)
+            key_b = (stat_b.st_mode, stat_b.st_uid, stat_b.st_gid, stat_b.st_mtime,
+                     stat_b.st_dev != parent_dev_b)
+        else:
+            key_a = (stat_a.st_mode, stat_a.st_size, stat_a.st_uid, stat_a.st_gid, stat_a.st_mtime,
+                     stat_a.st_dev != parent_dev_a)
+            key_b = (stat_b.st_mode, stat_b.st_size, stat_b.st_uid, stat_b.st_gid, stat_b.st_mtime,
+                     stat_b.st_dev != parent_dev_b)
+
+        # Fast path: "everything matches" is by far the common case, and one C-level tuple
+        # comparison rejects it much cheaper than the per-field cmp_prop cascade below, which
+        # only runs when something differs and a labelled record has to be produced.
+        if key_a == key_b:
+            continue
+
+        if not a_is_dir:
+            # compare file size only for files, not folders, because different filesystem drivers
+            # have different understandings of what 'size' is on directories, which makes it incomparable
+            if cmp_prop_local("stat.st_size", path_a, a_is_dir, stat_a.st_size, stat_b.st_size, sink): continue
+
+        # compare some more relevant metadata
+        if cmp_prop_local("stat.st_uid", path_a, a_is_dir, stat_a.st_uid, stat_b.st_uid, sink): continue
+        if cmp_prop_local("stat.st_gid", path_a, a_is_dir, stat_a.st_gid, stat_b.st_gid, sink): continue
+        if cmp_prop_local("stat.st_mtime", path_a, a_is_dir, stat_a.st_mtime, stat_b.st_mtime, sink): continue
+
+        # handle mount-points: an entry is a mount-point iff it sits on a different device than
+        # the directory we found it in, and we already have both stat results in hand
+        # (Path.is_mount() would redo two stat syscalls per side to answer the same question)
+        if stat_a.st_dev != parent_dev_a:
+            if stat_b.st_dev == parent_dev_b:
+                append_change_local(sink, path_a, a_is_dir, "is_mount")
+                continue
+            # this didn't really work well and also doesn't really make sense for what we're trying to achieve...
+            #if external:
+            #    #print("mount recurse", item_a)
+            #    cmp_dir(changes, item_a, item_b, recursive, external, follow_symlinks, recursion_depth + 1)
+
+        # compare less relevant modes
+        if cmp_prop_local("is_fifo", path_a, a_is_dir, S_ISFIFO(stat_a.st_mode), S_ISFIFO(stat_b.st_mode), sink): continue
+        if cmp_prop_local("is_block_device", path_a, a_is_dir, S_ISBLK(stat_a.st_mode), S_ISBLK(stat_b.st_mode), sink): continue
+        if cmp_prop_local("is_char_device", path_a, a_is_dir, S_ISCHR(stat_a.st_mode), S_ISCHR(stat_b.st_mode), sink): continue
+        if cmp_prop_local("is_socket", path_a, a_is_dir, S_ISSOCK(stat_a.st_mode), S_ISSOCK(stat_b.st_mode), sink): continue
+
+        # catch other modes
+        if cmp_prop_local("stat.st_mode", path_a, a_is_dir, stat_a.st_mode, stat_b.st_mode, sink): continue
+
+    # anything left over in the names_b_idx dict is something that doesn't exist in dir_a (reverse difference)
+    for i in names_b_idx.values():
+        sink.add(("missing", items_b[i].path))
+
+    return subdirs_to_recurse
+
+
+def _stat_chunk(args: tuple) -> list:
+    # one pool task lstats a chunk of names on both sides, fd-relative like the inline path
+    names, dir_a_fd, dir_b_fd = args
+    os_stat = os.stat
+    return [(os_stat(name, dir_fd=dir_a_fd, follow_symlinks=False),
+             os_stat(name, dir_fd=dir_b_fd, follow_symlinks=False)) for name in names]
+
+
+def append_change(sink, path_a: str, is_dir: bool, prop_name: str):
+    # the caller already knows both the path string and the dir-ness, so no syscalls here
+    if is_dir:
+        path_a += os.sep
+    sink.add((path_a, prop_name))
+
+
+def cmp_prop(prop_name: str, path_a: str, is_dir: bool, prop_a, prop_b, sink) -> bool:
+    if prop_a != prop_b:
+        append_change(sink, path_a, is_dir, prop_name + f"({prop_a}|{prop_b})")
+        return True
+    return False
@@ -1,11 +1,37 @@
 #!/usr/bin/python3
 import argparse
+import collections
+import concurrent.futures
 import json
 import os
+import platform
 import sys
+import threading
+import time
 from pathlib import Path
 from typing import Optional
-from stat import S_ISDIR, S_ISLNK, S_ISSOCK, S_ISBLK, S_ISCHR, S_ISFIFO
+
+# the hot per-entry loop lives in its own module so setup.py can compile it with Cython;
+# when the compiled extension has been built it shadows the plain .py file
+from _dircmp_inner import compare_entries_follow, compare_entries_nofollow, append_change
+
+try:
+    # optional: batches the per-entry stat syscalls through io_uring (Linux only)
+    import liburing
+except ImportError:
+    liburing = None
+
+try:
+    # optional: C JSON serializer, 5-10x faster than the stdlib on output-heavy runs
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _json_dumps = orjson.dumps  # emits UTF-8 bytes directly, no text-layer encode
+else:
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("UTF-8")
 
 
 RESTORE_CURSOR = "\033[u"
@@ -19,10 +45,14 @@ NO_COLOUR = "\033[0m"
 
 is_tty = sys.stdout.isatty()
 
-
-def tty_print(*args, **kwargs):
-    if is_tty:
+# decided once at import time: in script mode every tty_print call collapses to an immediate
+# no-op instead of re-testing is_tty (which can never change) on each of the many call sites
+if is_tty:
+    def tty_print(*args, **kwargs):
         print(*args, **kwargs)
+else:
+    def tty_print(*args, **kwargs):
+        pass
 
 
 def rethrow(ex: Optional[BaseException]):
@@ -34,6 +64,175 @@ def rethrow(ex: Optional[BaseException]):
 
 processed = 0
 total = 0
+_counter_lock = threading.Lock()
+
+
+class ChangeSink:
+    # Collects the discovered differences. Without an output file they are kept in a list for the
+    # report at the end; with one, each record is streamed to disk the moment it is found (as a
+    # JSON array, one record per line) and only a counter stays in memory, so memory use no longer
+    # grows with the number of differences.
+    def __init__(self, output: Optional[Path]):
+        self.count = 0
+        self._lock = threading.Lock()
+        if output is None:
+            self.records = []
+            self._file = None
+        else:
+            self.records = None
+            # binary mode: the serializer hands us UTF-8 bytes, no text layer needed in between
+            self._file = output.open("wb")
+            self._file.write(b"[")
+
+    def add(self, record: tuple):
+        with self._lock:
+            self.count += 1
+            if self._file is None:
+                self.records.append(record)
+            else:
+                self._file.write(b"\n  " if self.count == 1 else b",\n  ")
+                self._file.write(_json_dumps(record))
+
+    def close(self):
+        if self._file is not None:
+            self._file.write(b"\n]\n" if self.count else b"]\n")
+            self._file.close()
+            self._file = None
+
+# Traversal is syscall-bound, so threads overlap nicely despite the GIL, but more workers than
+# cores just adds contention (and Apple Silicon efficiency cores make wide pools a net loss).
+if sys.platform == "darwin" and platform.processor() == "arm":
+    _MAX_WORKERS = 4
+else:
+    _MAX_WORKERS = os.cpu_count() or 4
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+# separate pool for the B-side listings so traversal workers never wait on their own pool
+_scan_pool = concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+
+
+_last_progress_ts = 0.0
+_progress_lock = threading.Lock()
+
+
+def _print_progress(n_items: int, recursion_depth: int, sink: "ChangeSink"):
+    # The progress line is cosmetic, so it is rate-limited to 10 Hz: one print() per directory
+    # means tens of thousands of tiny locked-and-flushed terminal writes on large trees, which
+    # also serializes the traversal workers on the print lock. The line is composed into a
+    # single string and pushed out with one write + flush per tick.
+    global _last_progress_ts
+    if not is_tty:
+        return
+    now = time.monotonic()
+    with _progress_lock:
+        if now - _last_progress_ts < 0.1:
+            return
+        _last_progress_ts = now
+    sys.stdout.write(f"{RESTORE_CURSOR}{GREY}Searching {n_items} ({processed}/{total}),"
+                     f" depth {recursion_depth}, discovered {sink.count}{NO_COLOUR} ")
+    sys.stdout.flush()
+
+
+def _safe_scandir(path, sort_by_inode: bool = False):
+    # os.scandir hands us the dirent metadata for free, pathlib would throw it away.
+    # Matching between A and B is done by name, so listing order is irrelevant for correctness
+    # (main sorts the final change list before reporting) and sorting is pure overhead - except
+    # on the A side, whose order dictates the stat order: there the entries are sorted by inode
+    # (DirEntry.inode() is free, it comes straight from the getdents buffer), which keeps the
+    # stats close together on disk. The B side is only ever consumed through the name dict, so
+    # it is returned as-is.
+    try:
+        with os.scandir(path) as scan:
+            if sort_by_inode:
+                return sorted(scan, key=lambda entry: entry.inode()), None
+            return list(scan), None
+    except Exception as e:
+        ex_name = type(e).__name__
+        tty_print(end=RED)
+        print(f"Failed to list '{path}' due to {ex_name}")
+        tty_print(end=NO_COLOUR)
+        return [], ex_name
+
+# SQEs per io_uring submission; beyond ~128 the bigger batch only adds latency, not throughput
+_STATX_BATCH = 128
+_AT_SYMLINK_NOFOLLOW = 0x100
+# STATX_TYPE | STATX_MODE | STATX_UID | STATX_GID | STATX_MTIME | STATX_INO | STATX_SIZE
+# (STATX_TYPE is what guarantees the S_IFMT bits of stx_mode; STATX_MODE only covers permissions)
+_STATX_WANTED = 0x1 | 0x2 | 0x8 | 0x10 | 0x40 | 0x100 | 0x200
+
+# just the stat_result fields cmp_dir actually compares
+_BatchStat = collections.namedtuple("_BatchStat",
+                                    ["st_mode", "st_size", "st_uid", "st_gid", "st_mtime",
+                                     "st_dev", "st_ino"])
+
+
+def _batch_lstat(dir_path, names) -> Optional[dict]:
+    # lstat every name in dir_path with one io_uring submission per _STATX_BATCH entries, letting
+    # the kernel pipeline the metadata fetches instead of paying one user/kernel round-trip each.
+    # Returns None when that is not possible (no liburing, or any entry failed); the caller then
+    # falls back to ordinary per-entry stat calls, which also produce the proper OSError.
+    if liburing is None or not names:
+        return None
+    try:
+        dir_fd = os.open(dir_path, os.O_PATH | os.O_DIRECTORY)
+    except OSError:
+        return None
+    try:
+        ring = liburing.io_uring()
+        cqe = liburing.io_uring_cqe()
+        liburing.io_uring_queue_init(_STATX_BATCH, ring, 0)
+        try:
+            results = {}
+            for start in range(0, len(names), _STATX_BATCH):
+                chunk = names[start:start + _STATX_BATCH]
+                buffers = [liburing.statx() for _ in chunk]
+                # the SQEs hold raw pointers into these bytes objects, so the list must stay
+                # alive until the chunk's CQEs have been harvested below
+                encoded = [os.fsencode(name) for name in chunk]
+                for i in range(len(chunk)):
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_statx(sqe, buffers[i], encoded[i],
+                                                 _AT_SYMLINK_NOFOLLOW, _STATX_WANTED, dir_fd)
+                liburing.io_uring_submit_and_wait(ring, len(chunk))
+                failed = False
+                for _ in chunk:
+                    liburing.io_uring_wait_cqe(ring, cqe)
+                    if cqe.res < 0:
+                        failed = True
+                    liburing.io_uring_cqe_seen(ring, cqe)
+                if failed:
+                    return None
+                for i, name in enumerate(chunk):
+                    buf = buffers[i]
+                    # the kernel may serve fewer fields than asked for; trust only complete buffers
+                    if buf.stx_mask & _STATX_WANTED != _STATX_WANTED:
+                        return None
+                    results[name] = _BatchStat(buf.stx_mode, buf.stx_size, buf.stx_uid, buf.stx_gid,
+                                               buf.stx_mtime,
+                                               os.makedev(buf.stx_dev_major, buf.stx_dev_minor),
+                                               buf.stx_ino)
+            return results
+        finally:
+            liburing.io_uring_queue_exit(ring)
+    except Exception:
+        # liburing is an optional accelerator; any hiccup just means the slow path is taken
+        return None
+    finally:
+        os.close(dir_fd)
+
+
+if liburing is not None:
+    # One-time capability probe: python-liburing's API has shifted between releases (this code
+    # targets the 2024.5.x line), and an API mismatch would otherwise be swallowed per directory
+    # by the except above - silently disabling the batching while still paying its setup cost on
+    # every level. Statx the current directory once and cross-check it against os.stat; on any
+    # disagreement the io_uring path is switched off for the whole run.
+    _probe = _batch_lstat(os.curdir, [os.curdir])
+    _probe_stat = os.stat(os.curdir)
+    if (_probe is None
+            or _probe[os.curdir].st_ino != _probe_stat.st_ino
+            or _probe[os.curdir].st_mode != _probe_stat.st_mode):
+        liburing = None
+    del _probe, _probe_stat
 
 
 def main(dir_a: Path, dir_b: Path, recursive: bool, external: bool, follow_symlinks: bool, output: Optional[Path]) -> int:
@@ -47,13 +246,23 @@ def main(dir_a: Path, dir_b: Path, recursive: bool, external: bool, follow_symli
     if not is_tty:
         print("Hint: running in script-mode, no progress output will be printed to stdout", file=sys.stderr)
 
-    changes = []
+    sink = ChangeSink(output)
     ex = None
     try:
         tty_print(end=STORE_CURSOR)
-        cmp_dir(changes, dir_a, dir_b, recursive, external, follow_symlinks)
+        # resolved once up front; the symlink containment check below compares against this
+        root_a = os.path.realpath(dir_a)
+        # follow_symlinks is fixed for the whole run, so pick the specialized loop once here
+        compare_impl = compare_entries_follow if follow_symlinks else compare_entries_nofollow
+        cmp_dir(sink, dir_a, dir_b, recursive, external, compare_impl,
+                dir_a.stat(), dir_b.stat(), root_a)
     except BaseException as e:
         ex = e
+        # Drop everything still queued, but wait out the levels already running: they hold
+        # references to the sink, and closing it (or sorting its records) under their feet
+        # would corrupt the final report. A level finishes in milliseconds, and nothing
+        # enqueues new work once the driver is gone.
+        _executor.shutdown(wait=True, cancel_futures=True)
         tty_print(end=RESTORE_CURSOR)
         tty_print(end=ORANGE)
         print(f"Warning: search aborted by {type(ex).__name__}, results will be incomplete!")
@@ -65,6 +274,7 @@ def main(dir_a: Path, dir_b: Path, recursive: bool, external: bool, follow_symli
     else:
         tty_print(end=RESTORE_CURSOR)
     finally:
+        sink.close()
         if processed == total:
             tty_print(end=GREEN)
         else:
@@ -72,7 +282,7 @@ def main(dir_a: Path, dir_b: Path, recursive: bool, external: bool, follow_symli
         print(f"Processed {processed} of {total} found items.", end=' ')
 
         # check for results
-        if len(changes) == 0:
+        if sink.count == 0:
             print()
             tty_print(end=GREEN)
             print("No differences discovered, directory contents seem superficially identical.")
@@ -80,151 +290,116 @@ def main(dir_a: Path, dir_b: Path, recursive: bool, external: bool, follow_symli
             rethrow(ex)
             return 0
 
-        # print differences
         tty_print(end=YELLOW)
-        print(f"Discovered {len(changes)} difference{'' if len(changes) == 1 else 's'}:")
+        print(f"Discovered {sink.count} difference{'' if sink.count == 1 else 's'}:")
         tty_print(end=NO_COLOUR)
         print()
-        changeset: tuple
-        for changeset in changes:
-            print(f"{changeset[0]}\t\t{changeset[1]}")
-        print()
-
-        # save differences in file, if requested
-        if output:
-            print(f"Writing results to '{output}'...", end=' ')
-            with output.open("w", encoding="UTF-8") as f:
-                json.dump(changes, f, ensure_ascii=False, indent=2)
-                print(file=f)
-            print("Done.")
+        if sink.records is not None:
+            # print differences (sorted once here, since traversal order is no longer deterministic)
+            sink.records.sort()
+            changeset: tuple
+            for changeset in sink.records:
+                print(f"{changeset[0]}\t\t{changeset[1]}")
+            print()
+        else:
+            # differences were already streamed to disk while searching, in discovery order
+            print(f"Results were written to '{output}'.")
+            print()
 
         rethrow(ex)
 
 
-def cmp_dir(changes: list,
-            dir_a: Path, dir_b: Path, recursive: bool, external: bool, follow_symlinks: bool,
-            recursion_depth: int = 0):
-    global processed, total
-
-    ex_a = None
-    ex_b = None
-    try:
-        items_a = sorted(dir_a.iterdir())
-    except Exception as e:
-        ex_a = type(e).__name__
-        items_a = []
-        tty_print(end=RED)
-        print(f"Failed to list '{dir_a}' due to {ex_a}")
-        tty_print(end=NO_COLOUR)
-
-    try:
-        items_b = sorted(dir_b.iterdir())
-    except Exception as e:
-        ex_b = type(e).__name__
-        items_b = []
-        tty_print(end=RED)
-        print(f"Failed to list '{dir_b}' due to {ex_b}")
-        tty_print(end=NO_COLOUR)
-
-    if ex_a != ex_b:
-        append_change(changes, dir_a, f"{ex_a} & {ex_b}")
-        return
-
-    item_names_b = {x.name: x for x in items_b}
-    total += len(items_a)
+def cmp_dir(sink: ChangeSink,
+            dir_a: Path, dir_b: Path, recursive: bool, external: bool, compare_impl,
+            stat_a: os.stat_result, stat_b: os.stat_result, root_a: str):
+    # Iterative driver: an explicit work-queue instead of Python recursion, so traversal depth is
+    # not bound by the interpreter stack and scheduling is decoupled from call order. Only this
+    # loop submits to the pool and only this loop waits, so pooled tasks never block on each other.
+    # The queue is popped LIFO (depth-first), which keeps the queue small on wide trees.
+    work = collections.deque()
+    work.append((dir_a, dir_b, stat_a.st_dev, stat_a.st_ino, stat_b.st_dev, stat_b.st_ino, 0))
+    seen_a = set()
+    pending = set()
+    while work or pending:
+        while work and len(pending) < _MAX_WORKERS:
+            task = work.pop()
+            ident_a = task[2], task[3]
+            ident_b = task[4], task[5]
+            # Equal (st_dev, st_ino) on both sides means A and B are literally the same
+            # directory (bind mount, identical snapshot) - nothing in it can differ, so the
+            # whole subtree is pruned for the cost of two already-paid stats.
+            if ident_a == ident_b:
+                continue
+            # an A-side directory inode seen before is a hardlink cycle - do not loop on it
+            if ident_a in seen_a:
+                continue
+            seen_a.add(ident_a)
+            pending.add(_executor.submit(_level_task, sink, task, recursive, external, compare_impl, root_a))
+        if not pending:
+            continue
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            work.extend(future.result())
 
-    # print progress
-    tty_print(end=RESTORE_CURSOR)
-    tty_print(f"{GREY}Searching {len(items_a)} ({processed}/{total}), depth {recursion_depth}, discovered {len(changes)}{NO_COLOUR}", end=' ')
-    if is_tty and len(items_a) >= 1000:
-        # make sure our status update is on-screen if the search could take a while
-        sys.stdout.flush()
 
-    # match items in B-list to items in A-list
-    for item_a in items_a:
-        processed += 1
+def _level_task(sink: ChangeSink, task: tuple, recursive: bool, external: bool, compare_impl,
+                root_a: str) -> list:
+    dir_a, dir_b, parent_dev_a, _parent_ino_a, parent_dev_b, _parent_ino_b, recursion_depth = task
+    return _cmp_dir_one_level(sink, dir_a, dir_b, recursive, external, compare_impl,
+                              parent_dev_a, parent_dev_b, recursion_depth, root_a)
 
-        if item_a.name not in item_names_b:
-            append_change(changes, item_a, "deleted")
-            continue
-        item_b = item_names_b[item_a.name]
-        del item_names_b[item_a.name]
-
-        # handle symlinks
-        stat_a = item_a.stat(follow_symlinks=False)
-        stat_b = item_b.stat(follow_symlinks=False)
-        if S_ISLNK(stat_a.st_mode):
-            # check if B is also a symlink
-            if not S_ISLNK(stat_b.st_mode):
-                append_change(changes, item_a, "is_symlink")
-                continue
 
-            # do not escape out of original search-path
-            if follow_symlinks:
-                if not str(item_a.resolve()).startswith(str(dir_a)):
-                    print(f"Absolute symlink at {item_a} points outside of searched filesystem, refusing to follow")
-                else:
-                    # resolve symlink
-                    stat_a = item_a.stat(follow_symlinks=True)
-                    stat_b = item_b.stat(follow_symlinks=True)
-
-        # handle subdirectories
-        if S_ISDIR(stat_a.st_mode):
-            if not S_ISDIR(stat_b.st_mode):
-                append_change(changes, item_a, "is_dir")
-                continue
-            if recursive:
-                # run comparison for this subdirectory
-                #print("recurse", item_a)
-                cmp_dir(changes, item_a, item_b, recursive, external, follow_symlinks, recursion_depth + 1)
-        else:
-            # compare file size only for files, not folders, because different filesystem drivers
-            # have different understandings of what 'size' is on directories, which makes it incomparable
-            if cmp_prop("stat.st_size", item_a, stat_a.st_size, stat_b.st_size, changes): continue
-
-        # compare some more relevant metadata
-        if cmp_prop("stat.st_uid", item_a, stat_a.st_uid, stat_b.st_uid, changes): continue
-        if cmp_prop("stat.st_gid", item_a, stat_a.st_gid, stat_b.st_gid, changes): continue
-        if cmp_prop("stat.st_mtime", item_a, stat_a.st_mtime, stat_b.st_mtime, changes): continue
-
-        # handle mount-points
-        if item_a.is_mount():
-            if not item_b.is_mount():
-                append_change(changes, item_a, "is_mount")
-                continue
-            # this didn't really work well and also doesn't really make sense for what we're trying to achieve...
-            #if external:
-            #    #print("mount recurse", item_a)
-            #    cmp_dir(changes, item_a, item_b, recursive, external, follow_symlinks, recursion_depth + 1)
+def _cmp_dir_one_level(sink: ChangeSink,
+                       dir_a: Path, dir_b: Path, recursive: bool, external: bool, compare_impl,
+                       parent_dev_a: int, parent_dev_b: int,
+                       recursion_depth: int, root_a: str) -> list:
+    # compares a single directory level and returns the work-queue entries for its subdirectories
+    global processed, total
 
-        # compare less relevant modes
-        if cmp_prop("is_fifo", item_a, S_ISFIFO(stat_a.st_mode), S_ISFIFO(stat_b.st_mode), changes): continue
-        if cmp_prop("is_block_device", item_a, S_ISBLK(stat_a.st_mode), S_ISBLK(stat_b.st_mode), changes): continue
-        if cmp_prop("is_char_device", item_a, S_ISCHR(stat_a.st_mode), S_ISCHR(stat_b.st_mode), changes): continue
-        if cmp_prop("is_socket", item_a, S_ISSOCK(stat_a.st_mode), S_ISSOCK(stat_b.st_mode), changes): continue
+    # List both sides at once: when A and B live on different devices (disk vs. backup mount, the
+    # typical use of this tool) this keeps both busy instead of idling one while the other serves.
+    # B goes to the dedicated listing pool; waiting for it from a traversal worker is safe because
+    # listing tasks never submit or wait on anything themselves.
+    fut_b = _scan_pool.submit(_safe_scandir, dir_b)
+    items_a, ex_a = _safe_scandir(dir_a, sort_by_inode=True)
+    items_b, ex_b = fut_b.result()
 
-        # catch other modes
-        if cmp_prop("stat.st_mode", item_a, stat_a.st_mode, stat_b.st_mode, changes): continue
+    if ex_a != ex_b:
+        append_change(sink, str(dir_a), True, f"{ex_a} & {ex_b}")
+        return []
+    if ex_a is not None:
+        # both sides failed the same way (e.g. an unreadable directory pair); _safe_scandir
+        # already reported it, and there is nothing to compare or open fds on
+        return []
 
-    # anything left over in the item_names_b array is something that doesn't exist in dir_a (reverse difference)
-    for item_b in item_names_b.values():
-        changes.append(("missing", str(item_b)))
+    with _counter_lock:
+        total += len(items_a)
 
-    return changes
+    # batch the metadata fetches through io_uring where available
+    stats_a = _batch_lstat(dir_a, [x.name for x in items_a]) if liburing is not None else None
+    stats_b = _batch_lstat(dir_b, [x.name for x in items_b]) if liburing is not None else None
 
+    # print progress
+    _print_progress(len(items_a), recursion_depth, sink)
 
-def append_change(changes: list, item_a: Path, prop_name: str):
-    path_a = str(item_a)
-    if item_a.is_dir():
-        path_a += os.sep
-    changes.append((path_a, prop_name))
+    # hold one fd per side for the duration of the level; the comparison loop stats each entry
+    # by basename relative to it, saving the kernel a full path walk per stat
+    dir_a_fd = os.open(dir_a, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        dir_b_fd = os.open(dir_b, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            subdirs_to_recurse = compare_impl(sink, items_a, items_b, dir_a, recursive,
+                                              parent_dev_a, parent_dev_b, recursion_depth, root_a,
+                                              stats_a, stats_b, dir_a_fd, dir_b_fd)
+        finally:
+            os.close(dir_b_fd)
+    finally:
+        os.close(dir_a_fd)
 
+    with _counter_lock:
+        processed += len(items_a)
 
-def cmp_prop(prop_name: str, item_a: Path, prop_a, prop_b, changes: list) -> bool:
-    if prop_a != prop_b:
-        append_change(changes, item_a, prop_name + f"({prop_a}|{prop_b})")
-        return True
-    return False
+    return subdirs_to_recurse
 
 
 if __name__ == '__main__':
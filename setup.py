@@ -0,0 +1,16 @@
+from setuptools import setup
+
+try:
+    # Optional: compile the hot inner comparison loop. _dircmp_inner is written as plain Python,
+    # so Cython compiles it in pure-Python mode and the resulting extension shadows the .py file.
+    # Build in place with: python setup.py build_ext --inplace
+    from Cython.Build import cythonize
+    ext_modules = cythonize("_dircmp_inner.py", language_level=3)
+except ImportError:
+    ext_modules = []
+
+setup(
+    name="dircmp",
+    py_modules=["dircmp", "_dircmp_inner"],
+    ext_modules=ext_modules,
+)